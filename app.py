@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, send_from_directory, render_template, redirect, url_for
+from flask import Flask, request, jsonify, send_from_directory, render_template, redirect, url_for, Response, stream_with_context
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
 from flask_cors import CORS
 from functools import wraps
@@ -7,8 +7,16 @@ from werkzeug.utils import secure_filename
 from dotenv import load_dotenv  # Import dotenv to manage environment variables
 from datetime import datetime, timezone
 import requests
+import json
+import csv
+import io
+import math
+import click
+from flask.cli import AppGroup
+from sqlalchemy.exc import DBAPIError
 
-from extensions import db, migrate, jwt
+from extensions import db, migrate, jwt, dialect_insert
+from change_feed import ChangeFeed, record_change
 
 # Load environment variables from .env file
 load_dotenv()
@@ -31,7 +39,19 @@ jwt.init_app(app)
 CORS(app)
 
 # Import models after initializing db to avoid circular imports
-from models import User, Movie, Rating, UploadedFile
+from models import User, Movie, Rating, RatingArchive, ArchivedRating, UploadedFile
+
+# Reader for the shared log of rating changes served to live clients
+change_feed = ChangeFeed()
+change_feed.init_app(app)
+
+from rating_stats import RatingSnapshot, rating_summary, movie_stats, user_stats
+from rating_archive import archive_ratings, create_partitions, update_archived_rating, delete_archived_rating
+from catalog_snapshot import export_catalog, import_catalog
+
+# Columnar snapshot of ratings shared by all workers for analytics
+rating_snapshot = RatingSnapshot(app.config['STATS_SNAPSHOT_DIR'],
+                                 max_age=app.config['STATS_SNAPSHOT_MAX_AGE'])
 
 
 # ==========================
@@ -102,24 +122,139 @@ def admin_required(f):
 # MOVIE MANAGEMENT API
 # ====================
 
+# Helper Function to Validate Movie Fields
+def parse_movie(data):
+    """Build movie column values from request data; returns (values, error)."""
+    title = data.get('title')
+    if not isinstance(title, str) or not title.strip():
+        return None, 'Title is required'
+    title = title.strip()
+    if len(title) > 200:
+        return None, 'Title must be at most 200 characters'
+
+    vote_average = data.get('vote_average')
+    if vote_average in ('', None):
+        vote_average = None
+    else:
+        try:
+            if isinstance(vote_average, bool):
+                raise TypeError
+            vote_average = float(vote_average)
+            if not math.isfinite(vote_average):
+                raise ValueError
+        except (TypeError, ValueError):
+            return None, 'vote_average must be a number'
+
+    values = {'title': title, 'vote_average': vote_average}
+    for field, max_length in (('overview', None), ('release_date', 100), ('poster_path', 500)):
+        value = data.get(field) or None
+        if value is not None and not isinstance(value, str):
+            return None, f'{field} must be a string'
+        if value is not None and max_length and len(value) > max_length:
+            return None, f'{field} must be at most {max_length} characters'
+        values[field] = value
+    return values, None
+
+
+# Helper Function to Insert Movies, Skipping Existing Titles
+def insert_movies(rows):
+    """Insert movie rows in one statement; returns {title: id} for new movies.
+
+    Duplicate titles are skipped by the unique constraint on movies.title
+    instead of being looked up first.
+    """
+    stmt = dialect_insert(Movie).values(rows) \
+        .on_conflict_do_nothing(index_elements=[Movie.title]) \
+        .returning(Movie.id, Movie.title)
+    inserted = {title: movie_id for movie_id, title in db.session.execute(stmt)}
+    db.session.commit()
+    return inserted
+
+
 # Admin Adds a New Movie Endpoint
 @app.route('/movies', methods=['POST'])
 @admin_required
 def add_movie():
     """Admin adds a new movie to the database."""
     data = request.get_json()
-    title = data.get('title')
-
-    # Check if movie already exists
-    if Movie.query.filter_by(title=title).first():
+    if not isinstance(data, dict):
+        return jsonify({'message': 'Expected a JSON object'}), 400
+    values, error = parse_movie(data)
+    if error:
+        return jsonify({'message': error}), 400
+
+    # The unique title constraint rejects movies that already exist
+    inserted = insert_movies([values])
+    if values['title'] not in inserted:
         return jsonify({'message': 'Movie already exists'}), 409
 
-    # Add new movie
-    new_movie = Movie(title=title)
-    db.session.add(new_movie)
-    db.session.commit()
+    return jsonify({'message': 'Movie added successfully', 'movie_id': inserted[values['title']]}), 201
 
-    return jsonify({'message': 'Movie added successfully', 'movie_id': new_movie.id}), 201
+
+# Admin Bulk Adds Movies Endpoint
+@app.route('/movies/bulk', methods=['POST'])
+@admin_required
+def add_movies_bulk():
+    """Admin adds many movies from a JSON array or CSV file, in batches."""
+    if 'file' in request.files:
+        records = csv.DictReader(io.TextIOWrapper(request.files['file'].stream, encoding='utf-8-sig'))
+    elif request.mimetype == 'text/csv':
+        # utf-8-sig drops the byte order mark spreadsheet exports start with
+        records = csv.DictReader(io.TextIOWrapper(request.stream, encoding='utf-8-sig'))
+    else:
+        records = request.get_json(silent=True)
+        if isinstance(records, dict):
+            records = records.get('movies')
+        if not isinstance(records, list):
+            return jsonify({'message': 'Expected a JSON array of movies or a CSV file'}), 400
+
+    batch_size = app.config['MOVIE_BULK_BATCH_SIZE']
+    report = []
+    batch = []
+
+    def flush(batch):
+        # Titles repeated within the batch are reported as duplicates after the first
+        inserted = insert_movies([values for _, values in batch])
+        for entry, values in batch:
+            movie_id = inserted.pop(values['title'], None)
+            if movie_id is None:
+                entry.update(status='duplicate', message='Movie already exists')
+            else:
+                entry.update(status='created', movie_id=movie_id)
+
+    records = iter(records)
+    row = 0
+    stream_error = None
+    while True:
+        try:
+            record = next(records, None)
+        except (UnicodeDecodeError, csv.Error) as e:
+            # Earlier batches are committed; keep the rows read so far and stop
+            stream_error = {'row': row + 1, 'title': None, 'status': 'error',
+                            'message': f'Could not read CSV: {e}'}
+            break
+        if record is None:
+            break
+        row += 1
+        record = record if isinstance(record, dict) else {}
+        values, error = parse_movie(record)
+        entry = {'row': row, 'title': values['title'] if values else record.get('title')}
+        report.append(entry)
+        if error:
+            entry.update(status='invalid', message=error)
+            continue
+        batch.append((entry, values))
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    if stream_error:
+        report.append(stream_error)
+
+    summary = {status: sum(1 for e in report if e['status'] == status)
+               for status in ('created', 'duplicate', 'invalid', 'error')}
+    return jsonify({'summary': summary, 'results': report}), 400 if stream_error else 200
 
 
 # User Submits a Rating Endpoint
@@ -142,13 +277,16 @@ def rate_movie(movie_id):
     # Check if user already rated the movie
     identity = get_jwt_identity()
     user_id = identity['id']
-    existing_rating = Rating.query.filter_by(user_id=user_id, movie_id=movie_id).first()
+    existing_rating = Rating.query.filter_by(user_id=user_id, movie_id=movie_id).first() \
+        or ArchivedRating.query.get((user_id, movie_id))
     if existing_rating:
         return jsonify({'message': 'You have already rated this movie'}), 409
 
     # Add the new rating
     new_rating = Rating(rating=rating_value, user_id=user_id, movie_id=movie_id)
     db.session.add(new_rating)
+    db.session.flush()
+    record_change('created', new_rating.id, movie_id, user_id, rating_value)
     db.session.commit()
 
     return jsonify({'message': 'Rating submitted successfully'}), 201
@@ -185,6 +323,14 @@ def get_movie(movie_id):
     ratings = Rating.query.filter_by(movie_id=movie_id).all()
     ratings_list = [{'user_id': r.user_id, 'rating': r.rating} for r in ratings]
 
+    # Totals for ratings that were moved to archive files
+    archive = RatingArchive.query.get(movie_id)
+    archived_ratings = {
+        'count': archive.rating_count,
+        'average': round(archive.rating_sum / archive.rating_count, 3),
+        'archived_until': archive.archived_until.isoformat()
+    } if archive and archive.rating_count else None
+
     # Create movie_data dictionary with all necessary fields
     movie_data = {
         'id': movie.id,
@@ -193,7 +339,8 @@ def get_movie(movie_id):
         'release_date': movie.release_date,
         'poster_path': movie.poster_path,
         'vote_average': movie.vote_average,
-        'ratings': ratings_list
+        'ratings': ratings_list,
+        'archived_ratings': archived_ratings
     }
 
     return jsonify({'movie': movie_data}), 200
@@ -215,11 +362,18 @@ def update_rating(movie_id):
     identity = get_jwt_identity()
     user_id = identity['id']
     rating = Rating.query.filter_by(user_id=user_id, movie_id=movie_id).first()
-    if not rating:
+    archived = None if rating else ArchivedRating.query.get((user_id, movie_id))
+    if not rating and not archived:
         return jsonify({'message': 'Rating not found'}), 404
 
-    # Update rating
-    rating.rating = new_rating_value
+    # Update rating, or the archived one along with the movie's archived totals
+    if rating:
+        rating.rating = new_rating_value
+        rating_id = rating.id
+    else:
+        update_archived_rating(archived, new_rating_value)
+        rating_id = archived.rating_id
+    record_change('updated', rating_id, movie_id, user_id, new_rating_value)
     db.session.commit()
 
     return jsonify({'message': 'Rating updated successfully'}), 200
@@ -230,16 +384,66 @@ def update_rating(movie_id):
 @admin_required
 def delete_rating_admin(rating_id):
     """Admin deletes any user's rating for a movie."""
-    rating = Rating.query.get(rating_id)
+    rating = Rating.query.get(rating_id) or ArchivedRating.query.filter_by(rating_id=rating_id).first()
     if not rating:
         return jsonify({'message': 'Rating not found'}), 404
 
-    db.session.delete(rating)
+    movie_id, user_id = rating.movie_id, rating.user_id
+    if isinstance(rating, ArchivedRating):
+        delete_archived_rating(rating)
+    else:
+        db.session.delete(rating)
+    record_change('deleted', rating_id, movie_id, user_id)
     db.session.commit()
 
     return jsonify({'message': 'Rating deleted successfully'}), 200
 
 
+# Admin Bulk Deletes Ratings Matching a Filter Endpoint
+@app.route('/ratings', methods=['DELETE'])
+@admin_required
+def delete_ratings_bulk():
+    """Admin deletes all ratings matching a filter in a single statement."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'message': 'Expected a JSON object of filters'}), 400
+
+    # Collect the filters actually applied, so the guard below matches them
+    filters = []
+    for field in ('movie_id', 'user_id', 'rating'):
+        if field in data:
+            value = data[field]
+            if not isinstance(value, int) or isinstance(value, bool):
+                return jsonify({'message': f'{field} must be an integer'}), 400
+            filters.append(getattr(Rating, field) == value)
+    for field in ('before', 'after'):
+        if field in data:
+            value = data[field]
+            try:
+                if not isinstance(value, str) or not value:
+                    raise ValueError
+                value = datetime.fromisoformat(value)
+            except ValueError:
+                return jsonify({'message': f'{field} must be an ISO 8601 date'}), 400
+            if value.tzinfo is not None:
+                # Timestamps are stored as naive UTC
+                value = value.astimezone(timezone.utc).replace(tzinfo=None)
+            filters.append(Rating.timestamp < value if field == 'before' else Rating.timestamp >= value)
+
+    # Refuse to wipe the whole table by accident
+    if not filters:
+        return jsonify({'message': 'At least one filter is required'}), 400
+
+    query = Rating.query.filter(*filters)
+    deleted = query.delete(synchronize_session=False)
+    if deleted:
+        record_change('bulk_deleted', None, data.get('movie_id'), data.get('user_id'),
+                      data.get('rating'), count=deleted)
+    db.session.commit()
+
+    return jsonify({'message': 'Ratings deleted successfully', 'deleted': deleted}), 200
+
+
 # User Deletes Their Own Rating Endpoint
 @app.route('/movies/<int:movie_id>/rate', methods=['DELETE'])
 @jwt_required()
@@ -248,15 +452,206 @@ def delete_rating_user(movie_id):
     identity = get_jwt_identity()
     user_id = identity['id']
     rating = Rating.query.filter_by(user_id=user_id, movie_id=movie_id).first()
-    if not rating:
+    archived = None if rating else ArchivedRating.query.get((user_id, movie_id))
+    if not rating and not archived:
         return jsonify({'message': 'Rating not found'}), 404
 
-    db.session.delete(rating)
+    if rating:
+        rating_id = rating.id
+        db.session.delete(rating)
+    else:
+        rating_id = archived.rating_id
+        delete_archived_rating(archived)
+    record_change('deleted', rating_id, movie_id, user_id)
     db.session.commit()
 
     return jsonify({'message': 'Rating deleted successfully'}), 200
 
 
+# ==================
+# RATING CHANGE FEED
+# ==================
+
+# Pull-Based Rating Changes Endpoint
+@app.route('/ratings/changes', methods=['GET'])
+@jwt_required()
+def get_rating_changes():
+    """Retrieve rating changes after a given sequence number."""
+    since = request.args.get('since', 0, type=int)
+    events, latest, truncated = change_feed.since(since)
+    # When truncated, the client missed changes and should reload in full
+    return jsonify({'changes': events, 'latest_seq': latest, 'truncated': truncated}), 200
+
+
+# Stream Rating Changes for a Movie (Server-Sent Events) Endpoint
+@app.route('/movies/<int:movie_id>/events', methods=['GET'])
+def movie_events(movie_id):
+    """Stream rating changes for a specific movie as server-sent events."""
+    if not Movie.query.get(movie_id):
+        return jsonify({'message': 'Movie not found'}), 404
+
+    # Resume from Last-Event-ID on reconnect, otherwise start from now
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    since = request.args.get('since', last_id, type=int)
+    if since is None:
+        since = change_feed.latest_seq()
+
+    def stream(seq):
+        while True:
+            events, latest, truncated = change_feed.wait(seq, movie_id)
+            if truncated:
+                yield f'id: {latest}\nevent: reset\ndata: {{}}\n\n'
+            for event in events:
+                yield f"id: {event['seq']}\nevent: rating\ndata: {json.dumps(event)}\n\n"
+            if not events and not truncated:
+                yield ': keep-alive\n\n'
+            seq = latest
+
+    return Response(stream_with_context(stream(since)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# ======================
+# ADMIN RATING ANALYTICS
+# ======================
+
+# Helper Function to Load the Ratings Snapshot
+def load_rating_snapshot():
+    """Return snapshot columns (None until built), refreshing them in the background."""
+    rating_snapshot.ensure_fresh(app)
+    return rating_snapshot.columns()
+
+
+# Overall Rating Statistics (Admin Only) Endpoint
+@app.route('/admin/stats/ratings', methods=['GET'])
+@admin_required
+def get_rating_stats():
+    """Admin retrieves rating totals, distribution and ratings per day."""
+    cols = load_rating_snapshot()
+    if cols is None:
+        return jsonify({'message': 'Ratings snapshot is being built, try again shortly'}), 503
+    days = request.args.get('days', 30, type=int)
+    if days < 1:
+        return jsonify({'message': 'days must be a positive integer'}), 400
+    # Archived ratings are not in the snapshot; GET /movies/<id> reports them separately
+    return jsonify({'stats': rating_summary(cols, days=days), 'includes_archived': False}), 200
+
+
+# Per-Movie Rating Statistics (Admin Only) Endpoint
+@app.route('/admin/stats/movies', methods=['GET'])
+@admin_required
+def get_movie_rating_stats():
+    """Admin retrieves rating count, average and distribution per movie."""
+    cols = load_rating_snapshot()
+    if cols is None:
+        return jsonify({'message': 'Ratings snapshot is being built, try again shortly'}), 503
+    limit = request.args.get('limit', 20, type=int)
+    if limit < 1:
+        return jsonify({'message': 'limit must be a positive integer'}), 400
+    movie_id = request.args.get('movie_id', type=int)
+    return jsonify({'movies': movie_stats(cols, limit=limit, movie_id=movie_id), 'includes_archived': False}), 200
+
+
+# Per-User Rating Statistics (Admin Only) Endpoint
+@app.route('/admin/stats/users', methods=['GET'])
+@admin_required
+def get_user_rating_stats():
+    """Admin retrieves rating count and average per user."""
+    cols = load_rating_snapshot()
+    if cols is None:
+        return jsonify({'message': 'Ratings snapshot is being built, try again shortly'}), 503
+    limit = request.args.get('limit', 20, type=int)
+    if limit < 1:
+        return jsonify({'message': 'limit must be a positive integer'}), 400
+    user_id = request.args.get('user_id', type=int)
+    return jsonify({'users': user_stats(cols, limit=limit, user_id=user_id), 'includes_archived': False}), 200
+
+
+# Rebuild the Ratings Snapshot (Admin Only) Endpoint
+@app.route('/admin/stats/refresh', methods=['POST'])
+@admin_required
+def refresh_rating_stats():
+    """Admin refreshes the ratings snapshot, optionally rebuilding it in full."""
+    full = request.args.get('full', 'false').lower() in ('1', 'true', 'yes')
+    rows = rating_snapshot.refresh(full=full)
+    return jsonify({'message': 'Ratings snapshot refreshed', 'rows': rows}), 200
+
+
+# `flask stats refresh` for refreshing the snapshot from cron or a worker
+stats_cli = AppGroup('stats', help='Manage the ratings analytics snapshot.')
+
+
+@stats_cli.command('refresh')
+@click.option('--full', is_flag=True, help='Rebuild the snapshot from scratch.')
+def refresh_stats_command(full):
+    """Refresh the ratings snapshot."""
+    rows = rating_snapshot.refresh(full=full)
+    click.echo(f'Ratings snapshot holds {rows} ratings.')
+
+
+app.cli.add_command(stats_cli)
+
+
+# `flask ratings ...` for partition maintenance and archival
+ratings_cli = AppGroup('ratings', help='Manage ratings partitions and archives.')
+
+
+@ratings_cli.command('partitions')
+@click.option('--months-ahead', default=3, show_default=True, help='Months of future partitions to create.')
+def create_partitions_command(months_ahead):
+    """Create upcoming monthly ratings partitions (Postgres only); run it on a schedule."""
+    created = create_partitions(months_ahead=months_ahead)
+    if not created:
+        click.echo('Created partitions: none')
+    for partition in created:
+        click.echo(f"Created {partition['partition']}, moved {partition['moved']} ratings from ratings_default")
+
+
+@ratings_cli.command('archive')
+@click.option('--before', required=True, help='Archive ratings older than this month (YYYY-MM).')
+def archive_ratings_command(before):
+    """Move old ratings to compressed CSV files, keeping per-movie totals."""
+    try:
+        cutoff = datetime.strptime(before, '%Y-%m')
+    except ValueError:
+        raise click.BadParameter('expected YYYY-MM', param_hint='--before')
+    for month in archive_ratings(cutoff, app.config['ARCHIVE_FOLDER']):
+        click.echo(f"Archived {month['rows']} ratings from {month['month']} to {month['file']}")
+
+
+app.cli.add_command(ratings_cli)
+
+
+# `flask catalog export|import` for seeding environments without TMDB
+catalog_cli = AppGroup('catalog', help='Export and import movie catalog snapshots.')
+
+
+@catalog_cli.command('export')
+@click.argument('path')
+@click.option('--with-ratings', is_flag=True, help='Also export ratings, with placeholder users.')
+def export_catalog_command(path, with_ratings):
+    """Export the movie catalog to a compressed snapshot file."""
+    counts = export_catalog(path, include_ratings=with_ratings)
+    for table, rows in counts.items():
+        click.echo(f'Exported {rows} {table}')
+
+
+@catalog_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_catalog_command(path):
+    """Import a snapshot file into an empty database."""
+    try:
+        counts = import_catalog(path)
+    except (ValueError, DBAPIError) as e:
+        db.session.rollback()
+        raise click.ClickException(f'Import failed: {e}')
+    for table, rows in counts.items():
+        click.echo(f'Imported {rows} {table}')
+
+
+app.cli.add_command(catalog_cli)
+
+
 # =======================
 # FILE MANAGEMENT ROUTES
 # =======================
@@ -0,0 +1,154 @@
+import csv
+import gzip
+import io
+import json
+import secrets
+from datetime import datetime, timezone
+
+from sqlalchemy import func, select, text, union
+from werkzeug.security import generate_password_hash
+
+from change_feed import record_change
+from extensions import db
+from models import User, Movie, Rating, RatingArchive, ArchivedRating
+
+FORMAT_VERSION = 1
+
+# Tables in foreign key order; ratings need the users and movies they reference
+CATALOG_TABLES = [Movie.__table__]
+RATINGS_TABLES = [User.__table__, Movie.__table__, Rating.__table__,
+                  RatingArchive.__table__, ArchivedRating.__table__]
+
+# Users are exported as placeholders: only ids referenced by live or archived ratings, no credentials
+USER_COLUMNS = ['id', 'username']
+
+
+def export_catalog(path, include_ratings=False, chunk_size=5000):
+    """Write movies (and optionally ratings) to a gzipped snapshot.
+
+    The file is one JSON header line followed by one line per chunk, each
+    holding up to chunk_size rows of a single table stored column by column.
+    With ratings, archived rating totals and records are included too, and
+    the users they reference are written as placeholder accounts (id and a
+    generated username only).
+    Returns a dict of table name -> rows written.
+    """
+    tables = RATINGS_TABLES if include_ratings else CATALOG_TABLES
+    counts = {}
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        header = {
+            'version': FORMAT_VERSION,
+            'created': datetime.now(timezone.utc).isoformat(),
+            'tables': {t.name: _export_columns(t) for t in tables}
+        }
+        f.write(json.dumps(header) + '\n')
+        for table in tables:
+            counts[table.name] = 0
+            names = _export_columns(table)
+            for rows in _export_rows(table, chunk_size):
+                columns = {name: [_dump(row[i]) for row in rows] for i, name in enumerate(names)}
+                f.write(json.dumps({'table': table.name, 'columns': columns}) + '\n')
+                counts[table.name] += len(rows)
+    return counts
+
+
+def _export_columns(table):
+    return USER_COLUMNS if table is User.__table__ else [c.name for c in table.columns]
+
+
+def _export_rows(table, chunk_size):
+    if table is User.__table__:
+        user_ids = union(select(Rating.user_id), select(ArchivedRating.user_id)).subquery()
+        query = select(user_ids.c.user_id).order_by(user_ids.c.user_id)
+        result = db.session.execute(query.execution_options(yield_per=chunk_size))
+        for rows in result.partitions(chunk_size):
+            yield [(user_id, f'user{user_id}') for user_id, in rows]
+        return
+    result = db.session.execute(table.select().order_by(*table.primary_key.columns)
+                                .execution_options(yield_per=chunk_size))
+    yield from result.partitions(chunk_size)
+
+
+def import_catalog(path):
+    """Load a snapshot written by export_catalog into an empty database.
+
+    Chunks are read and inserted one at a time, with COPY on Postgres and
+    batched executemany elsewhere, then committed in one transaction.
+    Placeholder users get a password nobody knows and no admin rights.
+    Raises ValueError for unusable snapshots or non-empty target tables.
+    Returns a dict of table name -> rows loaded.
+    """
+    tables = {t.name: t for t in RATINGS_TABLES}
+    postgres = db.engine.dialect.name == 'postgresql'
+    counts = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot version: {header.get('version')}")
+        for name in header['tables']:
+            if name not in tables:
+                raise ValueError(f'Unknown table in snapshot: {name}')
+            if db.session.execute(select(func.count()).select_from(tables[name])).scalar():
+                raise ValueError(f'Table {name} is not empty; import into an empty database')
+            counts[name] = 0
+        # One random hash for every placeholder user, so none can log in
+        unusable_password = generate_password_hash(secrets.token_urlsafe(32))
+
+        for line in f:
+            chunk = json.loads(line)
+            table = tables[chunk['table']]
+            names = list(chunk['columns'])
+            rows = list(zip(*(chunk['columns'][n] for n in names)))
+            if table is User.__table__:
+                names = names + ['password_hash', 'is_admin']
+                rows = [row + (unusable_password, False) for row in rows]
+            if postgres:
+                _copy_rows(table, names, rows)
+            else:
+                _insert_rows(table, names, rows)
+            counts[table.name] += len(rows)
+
+    if postgres:
+        # Ids were loaded explicitly, so move each sequence past them
+        for name in counts:
+            if 'id' not in tables[name].c:
+                continue
+            db.session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{name}', 'id'), "
+                f"COALESCE((SELECT max(id) FROM {name}), 0) + 1, false)"))
+    if counts.get(Rating.__tablename__):
+        record_change('imported', None, None, None, count=counts[Rating.__tablename__])
+    db.session.commit()
+    return counts
+
+
+def _copy_rows(table, names, rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([r'\N' if v is None else v for v in row])
+    buf.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    # \N marks NULL so that empty strings survive the round trip
+    columns = ', '.join(f'"{n}"' for n in names)
+    try:
+        cursor.copy_expert(
+            f"COPY {table.name} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buf)
+    except db.engine.dialect.dbapi.Error as e:
+        # COPY runs on the raw driver cursor, so SQLAlchemy does not wrap its errors
+        raise ValueError(f'Could not load {table.name}: {e}') from e
+
+
+def _insert_rows(table, names, rows):
+    date_columns = {n for n in names if table.c[n].type.python_type is datetime}
+    params = [{n: _load_datetime(v) if n in date_columns else v for n, v in zip(names, row)}
+              for row in rows]
+    db.session.execute(table.insert(), params)
+
+
+def _dump(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _load_datetime(value):
+    return datetime.fromisoformat(value) if value else None
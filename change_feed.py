@@ -0,0 +1,126 @@
+from datetime import datetime, timezone
+import logging
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import func, or_, text
+
+from extensions import db
+from models import RatingChange
+
+logger = logging.getLogger(__name__)
+
+# Postgres advisory lock key that orders change log writes
+CHANGE_LOG_LOCK = 449
+# Old changes are pruned once every this many writes in a process
+PRUNE_EVERY = 100
+
+_writes = 0
+
+
+def record_change(change_type, rating_id, movie_id, user_id, rating=None, count=1):
+    """Add a rating change to the current transaction; the caller commits.
+
+    Bulk changes pass rating_id=None and the number of affected ratings
+    as count; movie_id=None means the change may touch any movie.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        # Held until commit, so sequence numbers become visible in order and
+        # readers never skip past a change that commits late
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': CHANGE_LOG_LOCK})
+    change = RatingChange(type=change_type, rating_id=rating_id, movie_id=movie_id,
+                          user_id=user_id, rating=rating, count=count,
+                          timestamp=datetime.now(timezone.utc))
+    db.session.add(change)
+
+    global _writes
+    _writes += 1
+    if _writes % PRUNE_EVERY == 0:
+        # Keep the newest CHANGE_FEED_SIZE changes
+        latest = db.session.query(func.max(RatingChange.id)).scalar() or 0
+        RatingChange.query.filter(RatingChange.id <= latest - current_app.config['CHANGE_FEED_SIZE']) \
+            .delete(synchronize_session=False)
+    return change
+
+
+class ChangeFeed:
+    """Reader for the rating_changes table, shared by every worker.
+
+    Every rating create, update or delete, from any worker or CLI command,
+    writes a row in the same transaction, keyed by the table's sequence.
+    Rows beyond the newest maxlen are pruned, so clients that fall too far
+    behind (or hold a sequence number from another database) are told to
+    reload. One poller thread per process watches the newest sequence number
+    and wakes up server-sent event streams.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.maxlen = 1000
+        self.poll_interval = 1.0
+        self._latest = 0
+        self._cond = threading.Condition()
+        self._poller = None
+
+    def init_app(self, app):
+        self.app = app
+        self.maxlen = app.config['CHANGE_FEED_SIZE']
+        self.poll_interval = app.config['CHANGE_FEED_POLL_INTERVAL']
+
+    def latest_seq(self):
+        return db.session.query(func.max(RatingChange.id)).scalar() or 0
+
+    def since(self, seq, movie_id=None):
+        """Return (events after seq, latest seq, truncated).
+
+        truncated is True when the caller missed changes: entries newer than
+        seq were already pruned, or seq is ahead of the log.
+        """
+        latest, oldest = db.session.query(func.max(RatingChange.id), func.min(RatingChange.id)).one()
+        latest = latest or 0
+        if seq > latest or (oldest is not None and seq < oldest - 1):
+            return [], latest, True
+
+        query = RatingChange.query.filter(RatingChange.id > seq, RatingChange.id <= latest)
+        if movie_id is not None:
+            query = query.filter(or_(RatingChange.movie_id == movie_id, RatingChange.movie_id.is_(None)))
+        changes = query.order_by(RatingChange.id).limit(self.maxlen).all()
+        if len(changes) == self.maxlen:
+            # Resume after the last returned change on the next call
+            latest = changes[-1].id
+        return [change.to_dict() for change in changes], latest, False
+
+    def wait(self, seq, movie_id=None, timeout=15):
+        """Return events after seq, blocking until there are some or the timeout expires."""
+        try:
+            events, latest, truncated = self.since(seq, movie_id)
+            if events or truncated or latest > seq:
+                return events, latest, truncated
+            # Do not hold a connection (or an open transaction) while waiting
+            db.session.close()
+            self._start_poller()
+            with self._cond:
+                self._cond.wait_for(lambda: self._latest > seq, timeout=timeout)
+            return self.since(seq, movie_id)
+        finally:
+            db.session.close()
+
+    def _start_poller(self):
+        with self._cond:
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, daemon=True)
+                self._poller.start()
+
+    def _poll(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    latest = self.latest_seq()
+                if latest != self._latest:
+                    with self._cond:
+                        self._latest = latest
+                        self._cond.notify_all()
+            except Exception:
+                logger.exception('Polling rating changes failed')
+            time.sleep(self.poll_interval)
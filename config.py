@@ -8,4 +8,10 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     UPLOAD_FOLDER = os.path.join(os.getcwd(), 'uploads')
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
-    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB limit
\ No newline at end of file
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB limit
+    CHANGE_FEED_SIZE = int(os.environ.get('CHANGE_FEED_SIZE', 1000))  # Rating changes kept in the rating_changes table
+    CHANGE_FEED_POLL_INTERVAL = float(os.environ.get('CHANGE_FEED_POLL_INTERVAL', 1.0))  # Seconds between checks for new changes
+    STATS_SNAPSHOT_DIR = os.path.join(os.getcwd(), 'snapshots')
+    STATS_SNAPSHOT_MAX_AGE = int(os.environ.get('STATS_SNAPSHOT_MAX_AGE', 60))  # Seconds before a background refresh
+    ARCHIVE_FOLDER = os.path.join(os.getcwd(), 'archives')  # Compressed CSV files of archived ratings
+    MOVIE_BULK_BATCH_SIZE = 500  # Movies inserted per statement by POST /movies/bulk
\ No newline at end of file
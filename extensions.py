@@ -1,7 +1,15 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_jwt_extended import JWTManager
+from sqlalchemy.dialects import postgresql, sqlite
 
 db = SQLAlchemy()
 migrate = Migrate()
 jwt = JWTManager()
+
+
+def dialect_insert(table):
+    """INSERT construct supporting ON CONFLICT for the configured database."""
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    return sqlite.insert(table)
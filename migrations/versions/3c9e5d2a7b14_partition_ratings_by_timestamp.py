@@ -0,0 +1,125 @@
+"""Partition ratings by timestamp and add rating archives
+
+Revision ID: 3c9e5d2a7b14
+Revises: 871f971bc7d1
+Create Date: 2026-10-19 10:12:41.508112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9e5d2a7b14'
+down_revision = '871f971bc7d1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rating_archives',
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('rating_count', sa.Integer(), nullable=False),
+        sa.Column('rating_sum', sa.Integer(), nullable=False),
+        sa.Column('archived_until', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ),
+        sa.PrimaryKeyConstraint('movie_id')
+    )
+    op.create_table('archived_ratings',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('rating_id', sa.Integer(), nullable=False),
+        sa.Column('rating', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('user_id', 'movie_id'),
+        sa.UniqueConstraint('rating_id')
+    )
+
+    # The partition key must be part of the primary key and cannot be NULL
+    op.execute('UPDATE ratings SET "timestamp" = CURRENT_TIMESTAMP WHERE "timestamp" IS NULL')
+
+    # Native partitioning is Postgres only; other databases keep a plain table
+    if op.get_bind().dialect.name != 'postgresql':
+        with op.batch_alter_table('ratings', schema=None) as batch_op:
+            batch_op.alter_column('timestamp',
+                   existing_type=sa.DateTime(),
+                   nullable=False)
+            batch_op.create_index('ix_ratings_movie_id', ['movie_id'], unique=False)
+            batch_op.create_index('ix_ratings_user_id_movie_id', ['user_id', 'movie_id'], unique=False)
+        return
+
+    op.execute('ALTER SEQUENCE ratings_id_seq OWNED BY NONE')
+    op.execute('ALTER TABLE ratings RENAME TO ratings_unpartitioned')
+    op.execute('ALTER TABLE ratings_unpartitioned RENAME CONSTRAINT ratings_pkey TO ratings_unpartitioned_pkey')
+
+    op.execute("""
+        CREATE TABLE ratings (
+            id INTEGER NOT NULL DEFAULT nextval('ratings_id_seq'),
+            rating INTEGER NOT NULL,
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            movie_id INTEGER NOT NULL REFERENCES movies (id),
+            "timestamp" TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            PRIMARY KEY (id, "timestamp")
+        ) PARTITION BY RANGE ("timestamp")
+    """)
+    op.execute('CREATE TABLE ratings_default PARTITION OF ratings DEFAULT')
+
+    # One partition per month from the oldest rating to three months ahead
+    op.execute("""
+        DO $$
+        DECLARE m date;
+        BEGIN
+            FOR m IN SELECT generate_series(
+                date_trunc('month', COALESCE((SELECT min("timestamp") FROM ratings_unpartitioned), now())),
+                date_trunc('month', now()) + interval '3 months',
+                interval '1 month')::date
+            LOOP
+                EXECUTE format('CREATE TABLE %I PARTITION OF ratings FOR VALUES FROM (%L) TO (%L)',
+                               'ratings_p' || to_char(m, 'YYYY_MM'), m, (m + interval '1 month')::date);
+            END LOOP;
+        END $$
+    """)
+
+    op.execute("""
+        INSERT INTO ratings (id, rating, user_id, movie_id, "timestamp")
+        SELECT id, rating, user_id, movie_id, "timestamp" FROM ratings_unpartitioned
+    """)
+    op.execute('DROP TABLE ratings_unpartitioned')
+    op.execute('ALTER SEQUENCE ratings_id_seq OWNED BY ratings.id')
+    op.create_index('ix_ratings_movie_id', 'ratings', ['movie_id'])
+    op.create_index('ix_ratings_user_id_movie_id', 'ratings', ['user_id', 'movie_id'])
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('ALTER SEQUENCE ratings_id_seq OWNED BY NONE')
+        op.execute('ALTER TABLE ratings RENAME TO ratings_partitioned')
+        op.execute('ALTER TABLE ratings_partitioned RENAME CONSTRAINT ratings_pkey TO ratings_partitioned_pkey')
+        op.execute("""
+            CREATE TABLE ratings (
+                id INTEGER NOT NULL DEFAULT nextval('ratings_id_seq'),
+                rating INTEGER NOT NULL,
+                user_id INTEGER NOT NULL REFERENCES users (id),
+                movie_id INTEGER NOT NULL REFERENCES movies (id),
+                "timestamp" TIMESTAMP WITHOUT TIME ZONE,
+                CONSTRAINT ratings_pkey PRIMARY KEY (id)
+            )
+        """)
+        op.execute("""
+            INSERT INTO ratings (id, rating, user_id, movie_id, "timestamp")
+            SELECT id, rating, user_id, movie_id, "timestamp" FROM ratings_partitioned
+        """)
+        # Dropping the parent drops every partition with it
+        op.execute('DROP TABLE ratings_partitioned')
+        op.execute('ALTER SEQUENCE ratings_id_seq OWNED BY ratings.id')
+    else:
+        with op.batch_alter_table('ratings', schema=None) as batch_op:
+            batch_op.drop_index('ix_ratings_user_id_movie_id')
+            batch_op.drop_index('ix_ratings_movie_id')
+            batch_op.alter_column('timestamp',
+                   existing_type=sa.DateTime(),
+                   nullable=True)
+
+    op.drop_table('archived_ratings')
+    op.drop_table('rating_archives')
@@ -32,12 +32,57 @@ class Movie(db.Model):
 
 class Rating(db.Model):
     __tablename__ = 'ratings'
+    __table_args__ = (db.Index('ix_ratings_user_id_movie_id', 'user_id', 'movie_id'),)
 
+    # On Postgres the table is partitioned by month on timestamp, with (id, timestamp) as primary key
     id = db.Column(db.Integer, primary_key=True)
     rating = db.Column(db.Integer, nullable=False)  # Assume rating is between 1 and 5
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), nullable=False)
-    timestamp = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), nullable=False, index=True)
+    timestamp = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+class RatingArchive(db.Model):
+    __tablename__ = 'rating_archives'
+
+    # Per-movie totals of ratings moved out of the ratings table by archival
+    movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), primary_key=True)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    archived_until = db.Column(db.DateTime, nullable=True)  # Ratings before this time are archived
+
+class ArchivedRating(db.Model):
+    __tablename__ = 'archived_ratings'
+
+    # Which user rated which movie before archival, so it cannot be rated twice
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), primary_key=True)
+    rating_id = db.Column(db.Integer, unique=True, nullable=False)  # Id the rating had in the ratings table
+    rating = db.Column(db.Integer, nullable=False)
+
+class RatingChange(db.Model):
+    __tablename__ = 'rating_changes'
+
+    # Log of rating changes read by the change feed; id is the sequence number
+    id = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.String(20), nullable=False)  # created, updated, deleted, bulk_deleted, archived, imported
+    rating_id = db.Column(db.Integer, nullable=True)
+    movie_id = db.Column(db.Integer, nullable=True)  # None when the change may touch any movie
+    user_id = db.Column(db.Integer, nullable=True)
+    rating = db.Column(db.Integer, nullable=True)
+    count = db.Column(db.Integer, nullable=False, default=1)  # Ratings affected by a bulk change
+    timestamp = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    def to_dict(self):
+        return {
+            'seq': self.id,
+            'type': self.type,
+            'rating_id': self.rating_id,
+            'movie_id': self.movie_id,
+            'user_id': self.user_id,
+            'rating': self.rating,
+            'count': self.count,
+            'timestamp': self.timestamp.replace(tzinfo=timezone.utc).isoformat()
+        }
 
 class UploadedFile(db.Model):
     __tablename__ = 'uploaded_files'
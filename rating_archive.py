@@ -0,0 +1,208 @@
+import csv
+import gzip
+import os
+from datetime import datetime, timezone
+
+from sqlalchemy import func, select, text
+
+from change_feed import record_change
+from extensions import db, dialect_insert
+from models import Rating, RatingArchive, ArchivedRating
+
+ARCHIVE_COLUMNS = ['id', 'rating', 'user_id', 'movie_id', 'timestamp']
+
+
+def month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def next_month(dt):
+    return datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'ratings_p{month:%Y_%m}'
+
+
+def is_partitioned():
+    """Whether ratings is a native Postgres partitioned table."""
+    if db.engine.dialect.name != 'postgresql':
+        return False
+    relkind = db.session.execute(
+        text("SELECT relkind FROM pg_class WHERE relname = 'ratings'")).scalar()
+    return relkind == 'p'
+
+
+def create_partitions(months_ahead=3):
+    """Create monthly ratings partitions up to months_ahead from now.
+
+    Rows that already landed in ratings_default for a missing month are moved
+    into the new partition, since Postgres refuses to create a partition
+    while the default partition holds rows in its range. Months before now
+    are covered too when the default partition holds rows for them.
+    Returns a list of {'partition', 'moved'} dicts for created partitions.
+    """
+    if not is_partitioned():
+        return []
+    existing = set(db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'ratings'")).scalars())
+    has_default = 'ratings_default' in existing
+
+    this_month = month_start(datetime.now(timezone.utc))
+    last = this_month
+    for _ in range(months_ahead):
+        last = next_month(last)
+    oldest_default = db.session.execute(
+        text('SELECT min("timestamp") FROM ratings_default')).scalar() if has_default else None
+    month = min(month_start(oldest_default), this_month) if oldest_default else this_month
+
+    created = []
+    while month <= last:
+        name = partition_name(month)
+        if name not in existing:
+            moved = _create_partition(name, month, next_month(month), has_default)
+            created.append({'partition': name, 'moved': moved})
+        month = next_month(month)
+    db.session.commit()
+    return created
+
+
+def _create_partition(name, start, end, has_default):
+    """Create one monthly partition, moving its rows out of ratings_default."""
+    bounds = f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+    in_range = {'start': start, 'end': end}
+    where = 'WHERE "timestamp" >= :start AND "timestamp" < :end'
+    moved = db.session.execute(
+        text(f'SELECT count(*) FROM ratings_default {where}'), in_range).scalar() if has_default else 0
+    if not moved:
+        db.session.execute(text(f'CREATE TABLE {name} PARTITION OF ratings {bounds}'))
+        return 0
+
+    columns = 'id, rating, user_id, movie_id, "timestamp"'
+    db.session.execute(text('ALTER TABLE ratings DETACH PARTITION ratings_default'))
+    db.session.execute(text(f'CREATE TABLE {name} PARTITION OF ratings {bounds}'))
+    db.session.execute(text(
+        f'INSERT INTO {name} ({columns}) SELECT {columns} FROM ratings_default {where}'), in_range)
+    db.session.execute(text(f'DELETE FROM ratings_default {where}'), in_range)
+    db.session.execute(text('ALTER TABLE ratings ATTACH PARTITION ratings_default DEFAULT'))
+    return moved
+
+
+def archive_ratings(before, archive_folder, batch_size=10000):
+    """Move ratings older than the month of `before` into gzipped CSV files.
+
+    Works one month at a time: the month's rows are streamed to
+    ratings_YYYY_MM.csv.gz, their per-movie count and sum are added to
+    rating_archives, who rated what is kept in archived_ratings, and then
+    the month's partition is dropped (or its rows deleted in one statement
+    when ratings is not partitioned).
+    Returns a list of {'month', 'rows', 'file'} dicts.
+    """
+    os.makedirs(archive_folder, exist_ok=True)
+    cutoff = month_start(before)
+    partitioned = is_partitioned()
+    oldest = db.session.query(func.min(Rating.timestamp)).filter(Rating.timestamp < cutoff).scalar()
+
+    archived = []
+    month = month_start(oldest) if oldest else cutoff
+    while month < cutoff:
+        end = next_month(month)
+        rows, path = _export_month(month, end, archive_folder, batch_size)
+        if rows:
+            _add_to_archive_totals(month, end)
+            _record_archived_ratings(month, end)
+            if partitioned:
+                _drop_partition(partition_name(month))
+            # Catches rows in the default partition or an unpartitioned table
+            Rating.query.filter(Rating.timestamp >= month, Rating.timestamp < end) \
+                .delete(synchronize_session=False)
+            record_change('archived', None, None, None, count=rows)
+            db.session.commit()
+            archived.append({'month': f'{month:%Y-%m}', 'rows': rows, 'file': path})
+        month = end
+    return archived
+
+
+def _export_month(start, end, archive_folder, batch_size):
+    query = db.session.query(*[getattr(Rating, c) for c in ARCHIVE_COLUMNS]) \
+        .filter(Rating.timestamp >= start, Rating.timestamp < end) \
+        .order_by(Rating.id).yield_per(batch_size)
+
+    path = os.path.join(archive_folder, f'ratings_{start:%Y_%m}.csv.gz')
+    if os.path.exists(path):
+        # Rows that arrived late for an already archived month
+        path = os.path.join(archive_folder, f'ratings_{start:%Y_%m}_{datetime.now(timezone.utc):%Y%m%d%H%M%S}.csv.gz')
+
+    rows = 0
+    with gzip.open(path, 'wt', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(ARCHIVE_COLUMNS)
+        for row in query:
+            writer.writerow([row.timestamp.isoformat() if c == 'timestamp' else getattr(row, c)
+                             for c in ARCHIVE_COLUMNS])
+            rows += 1
+    if not rows:
+        os.remove(path)
+        return 0, None
+    return rows, path
+
+
+def _add_to_archive_totals(start, end):
+    """Add the month's per-movie counts and sums to rating_archives."""
+    totals = db.session.query(Rating.movie_id, func.count(Rating.id), func.sum(Rating.rating)) \
+        .filter(Rating.timestamp >= start, Rating.timestamp < end) \
+        .group_by(Rating.movie_id).all()
+    if not totals:
+        return
+
+    latest = func.greatest if db.engine.dialect.name == 'postgresql' else func.max
+    stmt = dialect_insert(RatingArchive).values([
+        {'movie_id': movie_id, 'rating_count': count, 'rating_sum': total, 'archived_until': end}
+        for movie_id, count, total in totals
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[RatingArchive.movie_id],
+        set_={
+            'rating_count': RatingArchive.rating_count + stmt.excluded.rating_count,
+            'rating_sum': RatingArchive.rating_sum + stmt.excluded.rating_sum,
+            'archived_until': latest(RatingArchive.archived_until, stmt.excluded.archived_until)
+        })
+    db.session.execute(stmt)
+
+
+def _record_archived_ratings(start, end):
+    """Copy the month's (user, movie, rating) rows into archived_ratings."""
+    rows = select(Rating.user_id, Rating.movie_id, Rating.id, Rating.rating) \
+        .where(Rating.timestamp >= start, Rating.timestamp < end)
+    stmt = dialect_insert(ArchivedRating) \
+        .from_select(['user_id', 'movie_id', 'rating_id', 'rating'], rows) \
+        .on_conflict_do_nothing()
+    db.session.execute(stmt)
+
+
+def update_archived_rating(archived, value):
+    """Change an archived rating and the movie's archived sum with it."""
+    RatingArchive.query.filter_by(movie_id=archived.movie_id).update(
+        {RatingArchive.rating_sum: RatingArchive.rating_sum + (value - archived.rating)},
+        synchronize_session=False)
+    archived.rating = value
+
+
+def delete_archived_rating(archived):
+    """Remove an archived rating from the movie's archived totals."""
+    RatingArchive.query.filter_by(movie_id=archived.movie_id).update(
+        {RatingArchive.rating_count: RatingArchive.rating_count - 1,
+         RatingArchive.rating_sum: RatingArchive.rating_sum - archived.rating},
+        synchronize_session=False)
+    db.session.delete(archived)
+
+
+def _drop_partition(name):
+    exists = db.session.execute(
+        text("SELECT 1 FROM pg_class WHERE relname = :name"), {'name': name}).scalar()
+    if exists:
+        db.session.execute(text(f'ALTER TABLE ratings DETACH PARTITION {name}'))
+        db.session.execute(text(f'DROP TABLE {name}'))
@@ -0,0 +1,362 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timezone
+
+import numpy as np
+from sqlalchemy import BigInteger, cast, func
+
+from extensions import db
+from models import Rating, RatingChange
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Column name -> dtype of the on-disk snapshot
+COLUMNS = {
+    'id': np.int64,
+    'user_id': np.int32,
+    'movie_id': np.int32,
+    'rating': np.int8,
+    'timestamp': np.int64  # Seconds since the epoch (UTC)
+}
+SECONDS_PER_DAY = 86400
+# A lock file older than this was left behind by a crashed refresh (no flock)
+STALE_LOCK_AGE = 3600
+
+
+class RatingSnapshot:
+    """Columnar, memory-mapped snapshot of the ratings table for analytics.
+
+    Each generation is a directory of one .npy file per column, named after
+    the highest rating id it contains. A CURRENT file points at the live
+    generation, so every worker maps the same files and a refresh swaps
+    generations atomically. Refreshes hold a lock file in the snapshot
+    directory, so only one worker builds at a time.
+
+    Generations also record the newest rating_changes sequence number they
+    have seen. A refresh only appends new rows unless the change log shows
+    older ratings were updated or deleted since then.
+    """
+
+    def __init__(self, snapshot_dir, max_age=60, batch_size=10000):
+        self.snapshot_dir = snapshot_dir
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._generation = None
+        self._columns = None
+
+    # ---- Reading ----
+
+    def columns(self):
+        """Return the current generation's columns as read-only memmaps."""
+        generation = self._read_current()
+        if generation is None:
+            return None
+        if generation != self._generation:
+            path = os.path.join(self.snapshot_dir, generation)
+            try:
+                self._columns = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+                                 for name in COLUMNS}
+            except OSError:
+                # Replaced by a concurrent refresh; keep serving the mapped generation
+                return self._columns
+            self._generation = generation
+        return self._columns
+
+    def age(self):
+        """Seconds since the current generation was built, or None."""
+        try:
+            return time.time() - os.path.getmtime(self._current_path())
+        except OSError:
+            return None
+
+    def ensure_fresh(self, app):
+        """Build or refresh the snapshot in the background if missing or stale.
+
+        Never blocks; columns() returns None until the first build finishes.
+        """
+        age = self.age()
+        if (age is None or age > self.max_age) and not self._lock.locked():
+            threading.Thread(target=self._refresh_in_context, args=(app,), daemon=True).start()
+
+    # ---- Building ----
+
+    def refresh(self, full=False, if_stale=False):
+        """Append ratings newer than the snapshot, rebuilding if older rows changed.
+
+        With if_stale, nothing is done when another worker refreshed the
+        snapshot within max_age. Returns the number of rows in the snapshot.
+        """
+        if not self._lock.acquire(blocking=False):
+            # Another thread is already refreshing; serve what we have
+            return self._row_count()
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            with _exclusive_lock(os.path.join(self.snapshot_dir, '.lock')) as locked:
+                if not locked:
+                    # Another worker is already refreshing; serve what we have
+                    return self._row_count()
+                age = self.age()
+                if if_stale and age is not None and age <= self.max_age:
+                    return self._row_count()
+                return self._refresh_locked(full)
+        finally:
+            self._lock.release()
+
+    def _row_count(self):
+        cols = self.columns()
+        return 0 if cols is None else len(cols['id'])
+
+    def _refresh_locked(self, full):
+        # Read before the rows, so changes committed meanwhile are checked next time
+        seq = db.session.query(func.max(RatingChange.id)).scalar() or 0
+        cols = None if full else self.columns()
+        last_id = int(cols['id'][-1]) if cols is not None and len(cols['id']) else 0
+        if cols is not None and self._rows_changed(cols, last_id):
+            cols, last_id = None, 0
+
+        new_cols = self._fetch_since(last_id)
+        if cols is not None:
+            if not len(new_cols['id']):
+                self._touch_current()
+                return len(cols['id'])
+            new_cols = {name: np.concatenate([cols[name], new_cols[name]]) for name in COLUMNS}
+        self._write_generation(new_cols, seq)
+        return len(new_cols['id'])
+
+    def _refresh_in_context(self, app):
+        with app.app_context():
+            self.refresh(if_stale=True)
+
+    def _rows_changed(self, cols, last_id):
+        """Whether rows already in the snapshot may have been updated or deleted.
+
+        Looks for changes logged after the generation's sequence number: any
+        update or delete, or a rating created at or below last_id that the
+        snapshot lacks (it committed after a higher id was fetched). Falls
+        back to scanning the ratings table when that part of the log was
+        pruned.
+        """
+        seq = _generation_seq(self._generation)
+        oldest = db.session.query(func.min(RatingChange.id)).scalar()
+        if seq is None or seq < (oldest or 1) - 1:
+            return not self._is_consistent(cols)
+        changes = RatingChange.query.filter(RatingChange.id > seq)
+        if db.session.query(changes.filter(RatingChange.type != 'created').exists()).scalar():
+            return True
+        created = [rating_id for rating_id, in changes.with_entities(RatingChange.rating_id)
+                   .filter(RatingChange.rating_id <= last_id)]
+        return not np.isin(created, cols['id']).all()
+
+    def _is_consistent(self, cols):
+        """Check that rows already in the snapshot were not updated or deleted.
+
+        Compares the row count, the rating sum and an id-weighted rating sum,
+        so rating changes that cancel out in the plain sum are still caught.
+        This scans the ratings table, so it only runs when the change log
+        cannot answer.
+        """
+        if not len(cols['id']):
+            return True
+        count, total, weighted = db.session.query(
+            func.count(Rating.id), func.sum(Rating.rating),
+            func.sum(cast(Rating.id, BigInteger) * Rating.rating)) \
+            .filter(Rating.id <= int(cols['id'][-1])).one()
+        ratings = cols['rating'].astype(np.int64)
+        return count == len(cols['id']) \
+            and (total or 0) == int(ratings.sum()) \
+            and (weighted or 0) == int((cols['id'] * ratings).sum())
+
+    def _fetch_since(self, last_id):
+        """Load ratings with id > last_id into column arrays, in id order."""
+        query = db.session.query(Rating.id, Rating.user_id, Rating.movie_id, Rating.rating, Rating.timestamp) \
+            .filter(Rating.id > last_id).order_by(Rating.id).yield_per(self.batch_size)
+        chunks = {name: [] for name in COLUMNS}
+        batch = []
+        for row in query:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                self._append_batch(chunks, batch)
+                batch = []
+        if batch:
+            self._append_batch(chunks, batch)
+        return {name: np.concatenate(parts) if parts else np.empty(0, dtype=COLUMNS[name])
+                for name, parts in chunks.items()}
+
+    @staticmethod
+    def _append_batch(chunks, batch):
+        ids, user_ids, movie_ids, ratings, timestamps = zip(*batch)
+        chunks['id'].append(np.array(ids, dtype=COLUMNS['id']))
+        chunks['user_id'].append(np.array(user_ids, dtype=COLUMNS['user_id']))
+        chunks['movie_id'].append(np.array(movie_ids, dtype=COLUMNS['movie_id']))
+        chunks['rating'].append(np.array(ratings, dtype=COLUMNS['rating']))
+        chunks['timestamp'].append(np.array(
+            [_epoch(ts) for ts in timestamps], dtype=COLUMNS['timestamp']))
+
+    def _write_generation(self, cols, seq):
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        generation = f"gen-{int(cols['id'][-1]) if len(cols['id']) else 0}-{seq}-{time.time_ns()}"
+        tmp_dir = tempfile.mkdtemp(dir=self.snapshot_dir, prefix='.tmp-')
+        for name in COLUMNS:
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), cols[name])
+        os.rename(tmp_dir, os.path.join(self.snapshot_dir, generation))
+
+        previous = self._read_current()
+        tmp_current = os.path.join(self.snapshot_dir, f'.CURRENT-{os.getpid()}')
+        with open(tmp_current, 'w') as f:
+            f.write(generation)
+        os.replace(tmp_current, self._current_path())
+        if previous:
+            self._remove_generations_before(previous)
+
+    def _remove_generations_before(self, previous):
+        # Keep the previous generation for workers that have just read CURRENT;
+        # generations still mapped by other workers stay readable until unmapped
+        cutoff = _generation_key(previous)
+        for entry in os.listdir(self.snapshot_dir):
+            if entry.startswith('gen-') and _generation_key(entry) < cutoff:
+                shutil.rmtree(os.path.join(self.snapshot_dir, entry), ignore_errors=True)
+
+    def _touch_current(self):
+        os.utime(self._current_path())
+
+    def _current_path(self):
+        return os.path.join(self.snapshot_dir, 'CURRENT')
+
+    def _read_current(self):
+        try:
+            with open(self._current_path()) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+
+@contextmanager
+def _exclusive_lock(path):
+    """Try to take the lock file at path without waiting; yields whether it was taken."""
+    if fcntl is not None:
+        with open(path, 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+        return
+
+    # Without flock, whoever creates the file holds the lock
+    try:
+        if time.time() - os.path.getmtime(path) > STALE_LOCK_AGE:
+            os.remove(path)
+    except OSError:
+        pass
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        os.close(fd)
+        os.remove(path)
+
+
+def _generation_key(generation):
+    # gen-<max id>-<change seq>-<build time in ns>; the build time orders generations
+    try:
+        return int(generation.rsplit('-', 1)[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+def _generation_seq(generation):
+    """The rating_changes sequence number a generation is current with, or None."""
+    parts = (generation or '').split('-')
+    try:
+        return int(parts[2]) if len(parts) == 4 else None
+    except ValueError:
+        return None
+
+
+def _epoch(ts):
+    if ts is None:
+        return 0
+    # Timestamps are stored as naive UTC datetimes
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return int(ts.timestamp())
+
+
+# ---- Vectorized group-bys ----
+
+def rating_summary(cols, days=30):
+    """Overall count, mean, 1-5 distribution and ratings per day.
+
+    ratings_per_day covers the last `days` UTC calendar days, today included.
+    """
+    ratings = cols['rating']
+    total = len(ratings)
+    distribution = np.bincount(ratings, minlength=6)[1:6]
+    timestamps = cols['timestamp']
+    if days:
+        since = (int(time.time()) // SECONDS_PER_DAY - days + 1) * SECONDS_PER_DAY
+        timestamps = timestamps[timestamps >= since]
+    day_index, day_counts = np.unique(timestamps // SECONDS_PER_DAY, return_counts=True)
+    return {
+        'total_ratings': total,
+        'average_rating': round(float(ratings.mean()), 3) if total else None,
+        'distribution': {str(i + 1): int(c) for i, c in enumerate(distribution)},
+        'ratings_per_day': [
+            {'date': time.strftime('%Y-%m-%d', time.gmtime(int(d) * SECONDS_PER_DAY)), 'count': int(c)}
+            for d, c in zip(day_index, day_counts)
+        ]
+    }
+
+
+def movie_stats(cols, limit=20, movie_id=None):
+    """Per-movie count, mean and 1-5 distribution, most rated first."""
+    movie_ids = cols['movie_id'].astype(np.int64)
+    ratings = cols['rating'].astype(np.int64)
+    if not len(movie_ids):
+        return []
+    counts = np.bincount(movie_ids)
+    sums = np.bincount(movie_ids, weights=ratings)
+    dist = np.bincount(movie_ids * 5 + ratings - 1, minlength=len(counts) * 5).reshape(-1, 5)
+    if movie_id is not None:
+        selected = np.array([movie_id]) if 0 <= movie_id < len(counts) and counts[movie_id] else np.empty(0, np.int64)
+    else:
+        rated = np.flatnonzero(counts)
+        selected = rated[np.argsort(-counts[rated], kind='stable')][:limit]
+    return [{
+        'movie_id': int(m),
+        'count': int(counts[m]),
+        'average_rating': round(float(sums[m] / counts[m]), 3),
+        'distribution': {str(i + 1): int(c) for i, c in enumerate(dist[m])}
+    } for m in selected]
+
+
+def user_stats(cols, limit=20, user_id=None):
+    """Per-user count and mean rating, most active first."""
+    user_ids = cols['user_id'].astype(np.int64)
+    if not len(user_ids):
+        return []
+    counts = np.bincount(user_ids)
+    sums = np.bincount(user_ids, weights=cols['rating'].astype(np.int64))
+    if user_id is not None:
+        selected = np.array([user_id]) if 0 <= user_id < len(counts) and counts[user_id] else np.empty(0, np.int64)
+    else:
+        rated = np.flatnonzero(counts)
+        selected = rated[np.argsort(-counts[rated], kind='stable')][:limit]
+    return [{
+        'user_id': int(u),
+        'count': int(counts[u]),
+        'average_rating': round(float(sums[u] / counts[u]), 3)
+    } for u in selected]